@@ -0,0 +1,82 @@
+# 专用磁盘 I/O 执行器
+#
+# Pipeline 中的阻塞文件操作（写CSV、删除文件夹、扫描目录等）统一提交到这里，
+# 在独立线程池中执行并以 Deferred 的形式返回结果，避免阻塞 reactor 线程。
+
+import logging
+import threading
+
+from scrapy import signals
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+
+class _DaemonThreadPool(ThreadPool):
+    """工作线程设为守护线程，即使线程池没有被正常关闭也不会阻止进程退出"""
+
+    def threadFactory(self, *args, **kwargs):
+        thread = threading.Thread(*args, **kwargs)
+        thread.daemon = True
+        return thread
+
+
+class IOExecutor:
+    """
+    磁盘I/O线程池
+    - 所有任务通过 submit() 提交，返回 Deferred
+    - 执行器本身不限制排队任务数。背压来自 Pipeline：item 要等到自己的
+      I/O 任务完成才继续传递，等待中的 item 留在 Scrapy 的 scraper slot 中，
+      超过 SCRAPER_SLOT_MAX_ACTIVE_SIZE 后引擎暂停处理新的响应
+    - 同一个 crawler 内的所有 Pipeline 共享一个实例
+    - 线程池在引擎停止或 reactor 关闭时关闭（以先到者为准）
+    """
+
+    def __init__(self, max_workers=2):
+        self.threadpool = _DaemonThreadPool(minthreads=1, maxthreads=max_workers, name='caoliu-io')
+        self._started = False
+        self._shutdown_trigger = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """获取（或创建）当前 crawler 共享的执行器"""
+        executor = getattr(crawler, '_caoliu_io_executor', None)
+        if executor is None:
+            executor = cls(max_workers=crawler.settings.getint('CAOLIU_IO_THREADS', 2))
+            crawler._caoliu_io_executor = executor
+            crawler.signals.connect(executor.stop, signal=signals.engine_stopped)
+        return executor
+
+    def start(self):
+        if not self._started:
+            self.threadpool.start()
+            self._started = True
+            # 与 Twisted 自带线程池一致：reactor 关闭时一定关闭线程池，
+            # 即使 open_spider 失败导致 engine_stopped 没有发出
+            self._shutdown_trigger = reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+            logger.debug(f"I/O线程池已启动: 最大线程数 {self.threadpool.max}")
+
+    def stop(self):
+        """
+        关闭线程池
+        注意：会在 reactor 线程中等待工作线程结束，如果某个任务卡在
+        NFS 或没有读端的命名管道上，关闭会一直等到该任务返回
+        """
+        if self._started:
+            self._started = False
+            if self._shutdown_trigger is not None:
+                try:
+                    reactor.removeSystemEventTrigger(self._shutdown_trigger)
+                except (ValueError, KeyError):
+                    # 正在由 shutdown 触发器调用时已被移除
+                    pass
+                self._shutdown_trigger = None
+            self.threadpool.stop()
+            logger.debug("I/O线程池已关闭")
+
+    def submit(self, func, *args, **kwargs):
+        """在I/O线程中执行 func，返回携带其结果的 Deferred"""
+        self.start()
+        return deferToThreadPool(reactor, self.threadpool, func, *args, **kwargs)
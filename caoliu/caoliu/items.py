@@ -16,11 +16,15 @@ class CaoliuItem(scrapy.Item):
     title = scrapy.Field()
     # 图片URL列表（最多5张）
     image_urls = scrapy.Field()
+    # 其余候选图片URL（图床熔断时用于替换）
+    alternate_image_urls = scrapy.Field()
     # 下载后的图片路径
     images = scrapy.Field()
     # 下载链接（占位，后续完成）
     download_link = scrapy.Field()
     # 视频下载量（从列表页获取）
     download_count = scrapy.Field()
+    # 抓取时间（ISO 8601，带时区）
+    crawled_at = scrapy.Field()
     # 图片下载是否成功（Pipeline内部使用）
     download_success = scrapy.Field()
@@ -5,11 +5,21 @@
 
 from scrapy import signals
 from scrapy.http import HtmlResponse
+from scrapy.exceptions import IgnoreRequest
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.misc import build_from_crawler, load_object
+from collections import deque
+from urllib.parse import urlparse
+import json
 import logging
+import os
+import time
 
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
 
+from caoliu.ioexecutor import IOExecutor
+
 # Cloudflare 保护的图床域名列表
 CLOUDFLARE_PROTECTED_DOMAINS = [
     'tu.ymawv.la',
@@ -167,6 +177,7 @@ class CloudflareBypassMiddleware:
             logger.warning(f"无法处理 Cloudflare 保护的 URL: {request.url}")
             return None
         
+        start = time.time()
         try:
             logger.debug(f"使用 CloudScraper 下载: {request.url}")
             
@@ -179,6 +190,8 @@ class CloudflareBypassMiddleware:
                     'Accept': 'image/webp,image/apng,image/*,*/*;q=0.8',
                 }
             )
+            # 与 Scrapy 下载器一致，记录实际下载耗时（供图床熔断统计）
+            request.meta['download_latency'] = time.time() - start
             
             # 构造 Scrapy Response
             from scrapy.http import Response
@@ -192,7 +205,349 @@ class CloudflareBypassMiddleware:
             
         except Exception as e:
             logger.error(f"CloudScraper 请求失败 {request.url}: {e}")
+            # 失败的 cloudscraper 请求同样计入图床熔断（耗时可能长达 timeout），
+            # 之后的普通下载结果由熔断中间件另外记录
+            request.meta['cloudscraper_failure'] = time.time() - start
             return None
     
     def spider_opened(self, spider):
         spider.logger.info("CloudflareBypassMiddleware 已启用")
+
+
+class CircuitOpenError(IgnoreRequest):
+    """请求出队时所在图床已经熔断"""
+
+
+class HostCircuit:
+    """
+    单个图床的熔断状态
+    - closed: 正常放行，记录最近的成功/失败
+    - open: 直接拒绝，直到 open_until
+    - half_open: 只放行一个探测请求，成功则恢复，失败则延长熔断时间
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, window_size, open_seconds):
+        self.state = self.CLOSED
+        self.outcomes = deque(maxlen=window_size)
+        self.base_open_seconds = open_seconds
+        self.open_seconds = open_seconds
+        self.open_until = 0
+        # 探测请求丢失（如被其它中间件丢弃）时，到期后允许重新探测
+        self.probe_deadline = 0
+        self.avg_latency = None
+    
+    @property
+    def failure_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+    
+    def to_dict(self):
+        return {
+            'state': self.state,
+            'open_seconds': self.open_seconds,
+            'open_until': self.open_until,
+            'failure_rate': round(self.failure_rate, 3),
+            'avg_latency': self.avg_latency,
+        }
+    
+    def load(self, data, max_open_seconds):
+        """恢复上次运行保存的状态，half_open 按 open 恢复"""
+        state = data.get('state', self.CLOSED)
+        self.open_seconds = min(data.get('open_seconds', self.base_open_seconds), max_open_seconds)
+        self.open_until = data.get('open_until', 0)
+        self.avg_latency = data.get('avg_latency')
+        self.state = self.OPEN if state in (self.OPEN, self.HALF_OPEN) else self.CLOSED
+
+
+class ImageHostCircuitBreakerMiddleware:
+    """
+    图床熔断中间件
+    - 按域名统计最近请求的失败率（异常、403/429/5xx、下载耗时超过慢请求阈值都算失败）
+      耗时取下载器记录的 download_latency，不包括在下载队列中等待的时间
+    - 失败率超过阈值后熔断：请求改用 alternate_urls 中未熔断的候选图片，没有候选则直接失败
+    - 熔断时间到期后放行一个探测请求，只有探测请求的结果能恢复或重新熔断
+    - 请求进入下载队列时检查一次；熔断前已在队列中的请求，出队时由
+      CircuitBreakerDownloadHandler 再检查一次，熔断中同样改用候选图片或直接失败
+    - cloudscraper 请求失败（request.meta['cloudscraper_failure']）也记为一次失败
+    - 熔断状态在爬虫结束时保存，下次启动时恢复；当前状态写入 stats
+    - 爬虫自身的 allowed_domains 不参与熔断
+    
+    需要排在 RetryMiddleware(550) 之后，才能在重试之前记录每一次失败；
+    排在 CloudflareBypassMiddleware 之前，熔断的图床不会再走 cloudscraper
+    """
+    
+    FAILURE_STATUSES = {403, 429}
+    
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.window_size = settings.getint('CAOLIU_CIRCUIT_WINDOW', 20)
+        self.min_calls = settings.getint('CAOLIU_CIRCUIT_MIN_CALLS', 5)
+        self.failure_threshold = settings.getfloat('CAOLIU_CIRCUIT_FAILURE_RATE', 0.5)
+        self.slow_seconds = settings.getfloat('CAOLIU_CIRCUIT_SLOW_SECONDS', 15)
+        self.open_seconds = settings.getfloat('CAOLIU_CIRCUIT_OPEN_SECONDS', 60)
+        self.max_open_seconds = settings.getfloat('CAOLIU_CIRCUIT_MAX_OPEN_SECONDS', 1800)
+        self.state_file = settings.get('CAOLIU_CIRCUIT_STATE_FILE')
+        self.circuits = {}
+        self.excluded_domains = []
+    
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = cls(crawler)
+        # 供 CircuitBreakerDownloadHandler 在请求出队时查询同一份熔断状态
+        crawler._caoliu_circuit_breaker = s
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+    
+    def _get_circuit(self, host):
+        circuit = self.circuits.get(host)
+        if circuit is None:
+            circuit = self.circuits[host] = HostCircuit(self.window_size, self.open_seconds)
+        return circuit
+    
+    def _host_of(self, url):
+        host = urlparse(url).netloc.lower()
+        for domain in self.excluded_domains:
+            if host == domain or host.endswith('.' + domain):
+                return None
+        return host
+    
+    def _available(self, host):
+        """图床当前是否可以接收请求（不改变状态）"""
+        circuit = self.circuits.get(host)
+        if circuit is None or circuit.state == HostCircuit.CLOSED:
+            return True
+        now = time.time()
+        if circuit.state == HostCircuit.OPEN:
+            return now >= circuit.open_until
+        return now >= circuit.probe_deadline
+    
+    def _start_probe(self, host, circuit):
+        """熔断到期，转为 half_open 并放行一个探测请求"""
+        circuit.state = HostCircuit.HALF_OPEN
+        circuit.probe_deadline = time.time() + 2 * self.slow_seconds
+        self._update_state_stat(host, circuit)
+        self.stats.inc_value('circuit_breaker/probe')
+        logger.info(f"熔断探测: {host}")
+    
+    def process_request(self, request, spider):
+        host = self._host_of(request.url)
+        if host is None:
+            return None
+        
+        circuit = self.circuits.get(host)
+        if circuit is None or circuit.state == HostCircuit.CLOSED:
+            request.meta['circuit_host'] = host
+            request.meta['circuit_probe'] = False
+            return None
+        
+        if self._available(host):
+            self._start_probe(host, circuit)
+            request.meta['circuit_host'] = host
+            request.meta['circuit_probe'] = True
+            return None
+        
+        reroute = self._reroute(request)
+        if reroute is not None:
+            return reroute
+        self.stats.inc_value('circuit_breaker/fast_fail')
+        raise IgnoreRequest(f"图床已熔断: {host}")
+    
+    def check_dequeued(self, request):
+        """
+        请求出队、即将发出时再检查一次熔断（由 CircuitBreakerDownloadHandler 调用）
+        入队时熔断还是关闭的，排队期间图床可能已经熔断，此时抛出 CircuitOpenError，
+        由 process_exception 改用候选图片
+        """
+        host = request.meta.get('circuit_host')
+        if host is None or request.meta.get('circuit_probe'):
+            return
+        circuit = self.circuits.get(host)
+        if circuit is None or circuit.state == HostCircuit.CLOSED:
+            return
+        if self._available(host):
+            self._start_probe(host, circuit)
+            request.meta['circuit_probe'] = True
+            return
+        self.stats.inc_value('circuit_breaker/dequeue_fast_fail')
+        raise CircuitOpenError(f"图床已熔断: {host}")
+    
+    def _reroute(self, request):
+        """熔断中：换用未熔断图床上的候选图片，没有可用候选时返回 None"""
+        alternates = list(request.meta.get('alternate_urls', []))
+        while alternates:
+            alt_url = alternates.pop(0)
+            alt_host = self._host_of(alt_url)
+            if alt_host is None or self._available(alt_host):
+                self.stats.inc_value('circuit_breaker/rerouted')
+                logger.debug(f"图床已熔断，改用候选图片: {request.url} -> {alt_url}")
+                meta = dict(request.meta, alternate_urls=alternates)
+                meta.pop('circuit_host', None)
+                meta.pop('circuit_probe', None)
+                return request.replace(url=alt_url, meta=meta, dont_filter=True)
+        return None
+    
+    def _record_cloudscraper_failure(self, request, host):
+        latency = request.meta.pop('cloudscraper_failure', None)
+        if latency is not None:
+            self._record(host, False, latency, request.meta.get('circuit_probe', False))
+    
+    def process_response(self, request, response, spider):
+        host = request.meta.get('circuit_host')
+        if host is not None:
+            self._record_cloudscraper_failure(request, host)
+            latency = request.meta.get('download_latency')
+            failed = (
+                response.status >= 500
+                or response.status in self.FAILURE_STATUSES
+                or (latency is not None and latency >= self.slow_seconds)
+            )
+            self._record(host, not failed, latency, request.meta.get('circuit_probe', False))
+        return response
+    
+    def process_exception(self, request, exception, spider):
+        host = request.meta.get('circuit_host')
+        if host is None:
+            return None
+        self._record_cloudscraper_failure(request, host)
+        if isinstance(exception, CircuitOpenError):
+            # 出队时发现已熔断：与入队时一样改用候选图片，没有候选则按失败处理
+            reroute = self._reroute(request)
+            if reroute is None:
+                self.stats.inc_value('circuit_breaker/fast_fail')
+            return reroute
+        # IgnoreRequest 是主动丢弃，不算图床故障
+        if not isinstance(exception, IgnoreRequest):
+            self._record(host, False, None, request.meta.get('circuit_probe', False))
+        return None
+    
+    def _record(self, host, success, latency, probe):
+        """记录一次请求结果并更新熔断状态"""
+        circuit = self._get_circuit(host)
+        circuit.outcomes.append(success)
+        if latency is not None:
+            if circuit.avg_latency is None:
+                circuit.avg_latency = round(latency, 3)
+            else:
+                circuit.avg_latency = round(0.8 * circuit.avg_latency + 0.2 * latency, 3)
+        
+        # open / half_open 期间的非探测请求（熔断前已在队列中）只计入统计
+        if circuit.state == HostCircuit.HALF_OPEN and probe:
+            if success:
+                circuit.state = HostCircuit.CLOSED
+                circuit.outcomes.clear()
+                circuit.open_seconds = self.open_seconds
+                self.stats.inc_value('circuit_breaker/closed')
+                logger.info(f"图床已恢复，关闭熔断: {host}")
+            else:
+                circuit.open_seconds = min(circuit.open_seconds * 2, self.max_open_seconds)
+                self._open(host, circuit)
+        elif circuit.state == HostCircuit.CLOSED:
+            if len(circuit.outcomes) >= self.min_calls and circuit.failure_rate >= self.failure_threshold:
+                self._open(host, circuit)
+        
+        self._update_state_stat(host, circuit)
+    
+    def _open(self, host, circuit):
+        circuit.state = HostCircuit.OPEN
+        circuit.open_until = time.time() + circuit.open_seconds
+        self.stats.inc_value('circuit_breaker/opened')
+        logger.warning(
+            f"图床熔断: {host}, 失败率 {circuit.failure_rate:.0%}, "
+            f"平均耗时 {circuit.avg_latency or 0:.1f}s, {circuit.open_seconds:.0f}s 后探测"
+        )
+    
+    def _update_state_stat(self, host, circuit):
+        self.stats.set_value(f'circuit_breaker/state/{host}', circuit.state)
+        self.stats.set_value(
+            'circuit_breaker/open_hosts',
+            sum(1 for c in self.circuits.values() if c.state != HostCircuit.CLOSED),
+        )
+    
+    def spider_opened(self, spider):
+        self.excluded_domains = [d.lower() for d in getattr(spider, 'allowed_domains', None) or []]
+        if not self.state_file:
+            return None
+        d = IOExecutor.from_crawler(self.crawler).submit(self._load_state)
+        d.addCallback(self._restore, spider)
+        return d
+    
+    def _load_state(self):
+        """读取上次保存的熔断状态（I/O线程）"""
+        if not os.path.exists(self.state_file):
+            return {}
+        with open(self.state_file, encoding='utf-8') as f:
+            return json.load(f)
+    
+    def _restore(self, data, spider):
+        for host, state in data.items():
+            circuit = self._get_circuit(host)
+            circuit.load(state, self.max_open_seconds)
+            self._update_state_stat(host, circuit)
+        restored = [h for h, c in self.circuits.items() if c.state != HostCircuit.CLOSED]
+        if restored:
+            spider.logger.info(f"恢复熔断状态: {', '.join(restored)}")
+    
+    def spider_closed(self, spider):
+        if not self.state_file:
+            return None
+        # 只保存仍在熔断中的图床
+        data = {
+            host: circuit.to_dict()
+            for host, circuit in self.circuits.items()
+            if circuit.state != HostCircuit.CLOSED
+        }
+        return IOExecutor.from_crawler(self.crawler).submit(self._save_state, data)
+    
+    def _save_state(self, data):
+        """保存熔断状态（I/O线程）"""
+        directory = os.path.dirname(self.state_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.state_file + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.state_file)
+
+
+class CircuitBreakerDownloadHandler:
+    """
+    HTTP(S) 下载处理器包装
+    熔断中间件在请求进入下载队列前检查熔断，而 DOWNLOAD_DELAY 和并发限制下
+    请求可能在队列中等待很久；下载处理器在请求出队后才被调用，
+    这里用同一份熔断状态再检查一次，已熔断的图床不再发出请求，其余交给 Scrapy 默认的处理器
+    """
+    
+    lazy = False
+    
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self._handlers = {}
+    
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+    
+    def _get_handler(self, scheme):
+        handler = self._handlers.get(scheme)
+        if handler is None:
+            path = self.crawler.settings.getdict('DOWNLOAD_HANDLERS_BASE')[scheme]
+            handler = self._handlers[scheme] = build_from_crawler(load_object(path), self.crawler)
+        return handler
+    
+    async def download_request(self, request):
+        breaker = getattr(self.crawler, '_caoliu_circuit_breaker', None)
+        if breaker is not None:
+            breaker.check_dequeued(request)
+        return await self._get_handler(urlparse_cached(request).scheme).download_request(request)
+    
+    async def close(self):
+        for handler in self._handlers.values():
+            await handler.close()
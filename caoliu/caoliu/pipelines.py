@@ -6,10 +6,28 @@
 from itemadapter import ItemAdapter
 from scrapy.pipelines.images import ImagesPipeline
 from scrapy import Request
-from scrapy.exceptions import DropItem
+from scrapy.exceptions import DropItem, NotConfigured
+from scrapy.utils.log import failure_to_exc_info
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+from datetime import datetime, timezone
 import os
+import sys
 import csv
+import json
 import shutil
+import logging
+
+from caoliu.ioexecutor import IOExecutor
+from caoliu.search import ArchiveIndex, item_to_entry
+
+logger = logging.getLogger(__name__)
+
+
+def _log_open_failure(failure, spider, name):
+    """记录 open_spider 中I/O任务的失败并继续向上抛出"""
+    spider.logger.error(f"{name} 初始化失败: {failure.getErrorMessage()}", exc_info=failure_to_exc_info(failure))
+    return failure
 
 
 class CaoliuIndexPipeline:
@@ -18,22 +36,30 @@ class CaoliuIndexPipeline:
     注意：不在此处写入CSV，等图片下载成功后再写入
     """
     
-    def __init__(self, download_dir):
+    def __init__(self, download_dir, io_executor):
         self.download_dir = download_dir
+        self.io = io_executor
         self.video_counter = 0
     
     @classmethod
     def from_crawler(cls, crawler):
         download_dir = crawler.settings.get('CAOLIU_DOWNLOAD_DIR', './downloads')
-        return cls(download_dir)
+        return cls(download_dir, IOExecutor.from_crawler(crawler))
     
     def open_spider(self, spider):
-        """爬虫启动时，初始化"""
-        # 确保目录存在
+        """爬虫启动时，初始化（目录扫描在I/O线程中执行）"""
+        d = self.io.submit(self._prepare_download_dir)
+        d.addCallback(self._on_prepared, spider)
+        d.addErrback(_log_open_failure, spider, type(self).__name__)
+        return d
+    
+    def _prepare_download_dir(self):
+        """确保目录存在并查找已存在的最大video编号（I/O线程）"""
         os.makedirs(self.download_dir, exist_ok=True)
-        
-        # 查找已存在的最大video编号
-        self.video_counter = self._get_max_video_index()
+        return self._get_max_video_index()
+    
+    def _on_prepared(self, max_index, spider):
+        self.video_counter = max_index
         spider.logger.info(f"当前最大video编号: {self.video_counter}")
     
     def _get_max_video_index(self):
@@ -69,6 +95,7 @@ class CaoliuImagesPipeline(ImagesPipeline):
     def get_media_requests(self, item, info):
         """生成图片下载请求"""
         image_urls = item.get('image_urls', [])
+        alternates = item.get('alternate_image_urls', [])
         video_id = item.get('video_id', 'unknown')
         
         for idx, image_url in enumerate(image_urls):
@@ -76,7 +103,9 @@ class CaoliuImagesPipeline(ImagesPipeline):
                 url=image_url,
                 meta={
                     'video_id': video_id,
-                    'image_index': idx + 1
+                    'image_index': idx + 1,
+                    # 错开候选顺序，尽量避免多张图片替换成同一张
+                    'alternate_urls': alternates[idx:] + alternates[:idx],
                 }
             )
     
@@ -114,22 +143,51 @@ class CaoliuFinalPipeline:
     最终处理Pipeline
     - 只有图片下载成功的item才写入CSV
     - 下载失败的item删除其文件夹并丢弃
+    - 所有文件操作都在I/O线程中执行；CSV按批次合并写入（group commit），
+      item在其所在批次落盘后才继续向下传递
+    - 每批同时增量更新检索索引（见 caoliu.search）
     """
     
-    def __init__(self, download_dir):
+    CSV_HEADER = ['video_id', 'title', 'download_link', 'download_count', 'image_count']
+    
+    def __init__(self, download_dir, io_executor, batch_size=20, flush_interval=1.0, search_db=None):
         self.download_dir = download_dir
+        self.io = io_executor
+        self.search_db = search_db
+        self.search_index = None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
         self.csv_file = None
         self.csv_writer = None
         self.success_count = 0
         self.fail_count = 0
+        # 等待写入的 (row, entry, deferred) 列表
+        self._pending_rows = []
+        # 保证各批次按提交顺序写入
+        self._write_lock = defer.DeferredLock()
+        self._flush_loop = None
     
     @classmethod
     def from_crawler(cls, crawler):
-        download_dir = crawler.settings.get('CAOLIU_DOWNLOAD_DIR', './downloads')
-        return cls(download_dir)
+        settings = crawler.settings
+        return cls(
+            settings.get('CAOLIU_DOWNLOAD_DIR', './downloads'),
+            IOExecutor.from_crawler(crawler),
+            batch_size=settings.getint('CAOLIU_CSV_BATCH_SIZE', 20),
+            flush_interval=settings.getfloat('CAOLIU_CSV_FLUSH_INTERVAL', 1.0),
+            search_db=settings.get('CAOLIU_SEARCH_DB'),
+        )
     
     def open_spider(self, spider):
-        """爬虫启动时，打开CSV文件"""
+        """爬虫启动时，打开CSV文件并启动定时刷写"""
+        d = self.io.submit(self._open_csv)
+        d.addCallback(self._start_flush_loop)
+        d.addErrback(_log_open_failure, spider, type(self).__name__)
+        return d
+    
+    def _open_csv(self):
+        """打开CSV文件，新文件写入表头（I/O线程）"""
+        os.makedirs(self.download_dir, exist_ok=True)
         csv_path = os.path.join(self.download_dir, 'index.csv')
         file_exists = os.path.exists(csv_path)
         
@@ -138,7 +196,15 @@ class CaoliuFinalPipeline:
         
         # 如果是新文件，写入表头
         if not file_exists:
-            self.csv_writer.writerow(['video_id', 'title', 'download_link', 'download_count', 'image_count'])
+            self.csv_writer.writerow(self.CSV_HEADER)
+            self.csv_file.flush()
+        
+        if self.search_db:
+            self.search_index = ArchiveIndex(self.search_db, self.download_dir)
+    
+    def _start_flush_loop(self, _):
+        self._flush_loop = task.LoopingCall(self._flush)
+        self._flush_loop.start(self.flush_interval, now=False)
     
     def process_item(self, item, spider):
         """处理item，只有下载成功的才写入CSV"""
@@ -146,42 +212,335 @@ class CaoliuFinalPipeline:
         download_success = item.get('download_success', False)
         
         if download_success:
-            # 下载成功，写入CSV
-            self.csv_writer.writerow([
+            # 下载成功，加入待写入批次
+            d = defer.Deferred()
+            self._pending_rows.append(([
                 video_id,
                 item.get('title', ''),
                 item.get('download_link', ''),
                 item.get('download_count', ''),
                 len(item.get('images', []))
-            ])
-            self.csv_file.flush()  # 实时写入
-            self.success_count += 1
-            
-            spider.logger.info(f"✓ 保存成功: {video_id} -> {item.get('title', '')[:30]}...")
-            return item
+            ], item_to_entry(item), d))
+            if len(self._pending_rows) >= self.batch_size:
+                self._flush()
+            d.addCallback(self._on_saved, item, spider)
+            return d
         else:
-            # 下载失败，删除已创建的文件夹（如果存在）
+            # 下载失败，异步删除已创建的文件夹（如果存在）
             folder_path = os.path.join(self.download_dir, video_id)
-            if os.path.exists(folder_path):
-                try:
-                    shutil.rmtree(folder_path)
-                    spider.logger.info(f"✗ 已删除失败的文件夹: {folder_path}")
-                except Exception as e:
-                    spider.logger.error(f"删除文件夹失败 {folder_path}: {e}")
-            
-            self.fail_count += 1
-            spider.logger.warning(f"✗ 丢弃失败项: {video_id} -> {item.get('title', '')[:30]}...")
-            
-            # 抛出异常丢弃此item
-            raise DropItem(f"图片下载失败，已丢弃: {video_id}")
+            d = self.io.submit(self._remove_folder, folder_path)
+            d.addBoth(self._on_dropped, item, spider, folder_path)
+            return d
+    
+    def _flush(self):
+        """把当前批次提交到I/O线程写入CSV"""
+        if not self._pending_rows:
+            return defer.succeed(None)
+        
+        batch, self._pending_rows = self._pending_rows, []
+        rows = [row for row, _, _ in batch]
+        entries = [entry for _, entry, _ in batch]
+        
+        def _commit(result):
+            for _, _, waiter in batch:
+                waiter.callback(None)
+            return result
+        
+        def _fail(failure):
+            for _, _, waiter in batch:
+                waiter.errback(failure)
+            return None
+        
+        d = self._write_lock.run(self.io.submit, self._write_rows, rows, entries)
+        d.addCallbacks(_commit, _fail)
+        return d
+    
+    def _write_rows(self, rows, entries):
+        """批量写入CSV并更新检索索引（I/O线程）"""
+        self.csv_writer.writerows(rows)
+        self.csv_file.flush()
+        if self.search_index is not None:
+            # 索引只是辅助数据，失败不影响已写入CSV的item
+            try:
+                self.search_index.add_entries(entries)
+            except Exception as e:
+                logger.error(f"更新检索索引失败: {e}")
     
+    def _on_saved(self, _, item, spider):
+        self.success_count += 1
+        video_id = item.get('video_id', 'unknown')
+        spider.logger.info(f"✓ 保存成功: {video_id} -> {item.get('title', '')[:30]}...")
+        return item
+    
+    def _remove_folder(self, folder_path):
+        """删除文件夹，返回是否实际删除（I/O线程）"""
+        if os.path.exists(folder_path):
+            shutil.rmtree(folder_path)
+            return True
+        return False
+    
+    def _on_dropped(self, result, item, spider, folder_path):
+        video_id = item.get('video_id', 'unknown')
+        if isinstance(result, Failure):
+            spider.logger.error(f"删除文件夹失败 {folder_path}: {result.value}")
+        elif result:
+            spider.logger.info(f"✗ 已删除失败的文件夹: {folder_path}")
+        
+        self.fail_count += 1
+        spider.logger.warning(f"✗ 丢弃失败项: {video_id} -> {item.get('title', '')[:30]}...")
+        
+        # 抛出异常丢弃此item
+        raise DropItem(f"图片下载失败，已丢弃: {video_id}")
+    
+    @defer.inlineCallbacks
     def close_spider(self, spider):
-        """爬虫关闭时，关闭CSV文件并输出统计"""
-        if self.csv_file:
-            self.csv_file.close()
+        """爬虫关闭时，写入剩余批次、关闭CSV文件并输出统计"""
+        if self._flush_loop and self._flush_loop.running:
+            self._flush_loop.stop()
+        
+        try:
+            yield self._flush()
+        finally:
+            if self.csv_file:
+                yield self.io.submit(self.csv_file.close)
+            if self.search_index is not None:
+                yield self.io.submit(self.search_index.close)
         
         spider.logger.info(f"="*50)
         spider.logger.info(f"爬取完成统计:")
         spider.logger.info(f"  成功: {self.success_count} 个")
         spider.logger.info(f"  失败: {self.fail_count} 个")
         spider.logger.info(f"="*50)
+
+
+class CaoliuExportPipeline:
+    """
+    导出Pipeline（位于 CaoliuFinalPipeline 之后，只导出已保存的item）
+    - Parquet：按抓取日期分区（crawl_date=YYYY-MM-DD/），攒够一批或到达刷写间隔时
+      写入一个新的 part 文件，追加时不会重写已有分区。crawl_date 与 crawled_at 列
+      统一使用 UTC；写入失败的记录放回队列，下次刷写时重试
+    - JSONL：每个item一行，实时写入 stdout / 文件 / 命名管道，供下游流式消费
+    """
+    
+    # 导出字段（顺序即Parquet列顺序，新增字段只能追加到末尾）
+    EXPORT_FIELDS = [
+        'video_id', 'url', 'title', 'download_link', 'download_count',
+        'image_urls', 'images', 'crawled_at',
+    ]
+    
+    def __init__(self, io_executor, parquet_dir=None, jsonl_path=None, batch_size=500, flush_interval=60.0,
+                 stats=None):
+        self.io = io_executor
+        self.stats = stats
+        self.parquet_dir = parquet_dir
+        self.jsonl_path = jsonl_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.jsonl_file = None
+        # 下游读端关闭后置位，之后的写入直接跳过（在I/O线程中设置和检查）
+        self._jsonl_disabled = False
+        self._flush_loop = None
+        self._pa = None
+        self._pq = None
+        self._schema = None
+        self._pending_records = []
+        self._part_seq = 0
+        # 本次运行的标识，保证 part 文件名不与历史文件冲突
+        self._run_id = datetime.now().strftime('%Y%m%dT%H%M%S')
+        self._parquet_lock = defer.DeferredLock()
+        self._jsonl_lock = defer.DeferredLock()
+    
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        parquet_dir = settings.get('CAOLIU_EXPORT_PARQUET_DIR')
+        jsonl_path = settings.get('CAOLIU_EXPORT_JSONL')
+        if not parquet_dir and not jsonl_path:
+            raise NotConfigured('未配置 CAOLIU_EXPORT_PARQUET_DIR / CAOLIU_EXPORT_JSONL')
+        return cls(
+            IOExecutor.from_crawler(crawler),
+            parquet_dir=parquet_dir,
+            jsonl_path=jsonl_path,
+            batch_size=settings.getint('CAOLIU_EXPORT_BATCH_SIZE', 500),
+            flush_interval=settings.getfloat('CAOLIU_EXPORT_FLUSH_INTERVAL', 60.0),
+            stats=crawler.stats,
+        )
+    
+    def _load_pyarrow(self, spider):
+        """懒加载 pyarrow，未安装时禁用Parquet导出"""
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            spider.logger.warning("pyarrow 未安装，Parquet 导出已禁用")
+            self.parquet_dir = None
+            return
+        
+        self._pa = pa
+        self._pq = pq
+        self._schema = pa.schema([
+            ('video_id', pa.string()),
+            ('url', pa.string()),
+            ('title', pa.string()),
+            ('download_link', pa.string()),
+            ('download_count', pa.int64()),
+            ('image_urls', pa.list_(pa.string())),
+            ('images', pa.list_(pa.string())),
+            ('crawled_at', pa.timestamp('s', tz='UTC')),
+        ])
+    
+    def open_spider(self, spider):
+        """爬虫启动时，准备导出目标"""
+        if self.parquet_dir:
+            self._load_pyarrow(spider)
+        if self.parquet_dir:
+            self._flush_loop = task.LoopingCall(self._flush_parquet, spider)
+            self._flush_loop.start(self.flush_interval, now=False)
+        if self.jsonl_path:
+            # 打开命名管道会阻塞到读端就绪，放到I/O线程中执行
+            d = self.io.submit(self._open_jsonl)
+            d.addErrback(_log_open_failure, spider, type(self).__name__)
+            return d
+    
+    def _open_jsonl(self):
+        """打开JSONL输出，'-' 表示 stdout（I/O线程）"""
+        if self.jsonl_path == '-':
+            self.jsonl_file = sys.stdout
+        else:
+            self.jsonl_file = open(self.jsonl_path, 'a', encoding='utf-8')
+    
+    def _to_record(self, item):
+        """item转换为导出记录"""
+        record = {field: item.get(field) for field in self.EXPORT_FIELDS}
+        record['image_urls'] = list(record['image_urls'] or [])
+        record['images'] = list(record['images'] or [])
+        if not record['crawled_at']:
+            record['crawled_at'] = datetime.now().astimezone().isoformat(timespec='seconds')
+        return record
+    
+    def process_item(self, item, spider):
+        """记录加入Parquet批次；JSONL则立即写出"""
+        record = self._to_record(item)
+        
+        if self.parquet_dir:
+            self._pending_records.append(record)
+            if len(self._pending_records) >= self.batch_size:
+                self._flush_parquet(spider)
+        
+        if self.jsonl_file is None or self._jsonl_disabled:
+            return item
+        
+        # 等待写出完成再放行，下游消费慢时形成背压
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        d = self._jsonl_lock.run(self.io.submit, self._write_jsonl, line)
+        d.addCallback(self._on_jsonl_written, item, spider)
+        return d
+    
+    def _write_jsonl(self, line):
+        """写入一行并立即刷新，返回写出失败的异常（I/O线程）"""
+        if self._jsonl_disabled:
+            return None
+        try:
+            self.jsonl_file.write(line)
+            self.jsonl_file.flush()
+        except OSError as e:
+            # 下游读端已关闭（BrokenPipe等），停止流式输出，不影响其它导出
+            self._jsonl_disabled = True
+            self._close_jsonl()
+            return e
+        return None
+    
+    def _close_jsonl(self):
+        """关闭JSONL输出，stdout 不关闭（I/O线程）"""
+        if self.jsonl_file is not sys.stdout:
+            try:
+                self.jsonl_file.close()
+            except OSError:
+                pass
+    
+    def _on_jsonl_written(self, error, item, spider):
+        if error is not None:
+            spider.logger.error(f"JSONL 输出失败，已停止流式导出: {error}")
+        return item
+    
+    def _flush_parquet(self, spider):
+        """把当前批次提交到I/O线程写入Parquet"""
+        if not self._pending_records:
+            return defer.succeed(None)
+        
+        records, self._pending_records = self._pending_records, []
+        d = self._parquet_lock.run(self.io.submit, self._write_parquet, records)
+        d.addCallback(self._on_parquet_written, spider)
+        return d
+    
+    def _on_parquet_written(self, result, spider):
+        paths, failed, error = result
+        if paths:
+            spider.logger.info(f"Parquet 导出 -> {', '.join(paths)}")
+        if failed:
+            # 放回队列头部，下次刷写（定时或爬虫结束时）重试
+            self._pending_records[:0] = failed
+            if self.stats is not None:
+                self.stats.inc_value('caoliu_export/parquet_write_errors')
+            spider.logger.error(f"Parquet 导出失败，{len(failed)} 条记录等待重试: {error}")
+    
+    def _write_parquet(self, records):
+        """
+        按抓取日期（UTC）分区，每个分区写入一个新的part文件（I/O线程）
+        返回 (成功写入的路径, 写入失败的原始记录, 最后一次错误)
+        """
+        pa, pq = self._pa, self._pq
+        
+        partitions = {}
+        for record in records:
+            crawled_at = datetime.fromisoformat(record['crawled_at']).astimezone(timezone.utc)
+            partitions.setdefault(crawled_at.date().isoformat(), []).append(record)
+        
+        paths, failed, error = [], [], None
+        for crawl_date, partition_records in partitions.items():
+            try:
+                paths.append(self._write_partition(pa, pq, crawl_date, partition_records))
+            except Exception as e:
+                failed.extend(partition_records)
+                error = e
+        
+        return paths, failed, error
+    
+    def _write_partition(self, pa, pq, crawl_date, records):
+        """写入单个分区的part文件，返回文件路径（I/O线程）"""
+        rows = [
+            dict(record, crawled_at=datetime.fromisoformat(record['crawled_at']).astimezone(timezone.utc))
+            for record in records
+        ]
+        part_dir = os.path.join(self.parquet_dir, f'crawl_date={crawl_date}')
+        os.makedirs(part_dir, exist_ok=True)
+        
+        self._part_seq += 1
+        file_name = f'part-{self._run_id}-{self._part_seq:05d}.parquet'
+        path = os.path.join(part_dir, file_name)
+        # 先写隐藏临时文件再改名，读取方不会看到写了一半的文件
+        tmp_path = os.path.join(part_dir, f'.{file_name}.tmp')
+        
+        table = pa.Table.from_pylist(rows, schema=self._schema)
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+        return path
+    
+    @defer.inlineCallbacks
+    def close_spider(self, spider):
+        """爬虫关闭时，写出剩余批次并关闭JSONL输出"""
+        if self._flush_loop and self._flush_loop.running:
+            self._flush_loop.stop()
+        if self.parquet_dir:
+            yield self._flush_parquet(spider)
+            if self._pending_records:
+                # 最后一次重试仍失败，这些记录只存在于 index.csv 和检索索引中
+                if self.stats is not None:
+                    self.stats.set_value('caoliu_export/parquet_lost_records', len(self._pending_records))
+                spider.logger.error(f"Parquet 导出最终失败，丢失 {len(self._pending_records)} 条记录")
+        
+        # 等待已排队的JSONL写入完成
+        yield self._jsonl_lock.acquire()
+        self._jsonl_lock.release()
+        if self.jsonl_file is not None and not self._jsonl_disabled:
+            yield self.io.submit(self._close_jsonl)
@@ -0,0 +1,506 @@
+# 本地归档检索
+#
+# 基于 SQLite 的归档索引：
+# - 标题倒排索引（CJK 按二元组和单字切分，英文/数字按整词切分）
+# - download_count、抓取时间上的有序索引
+# - infohash 上的查找索引
+# 由 CaoliuFinalPipeline 在每批写入 index.csv 时增量更新，也可以通过命令行查询：
+#
+#     python -m caoliu.search title 关键词
+#     python -m caoliu.search infohash <infohash 或 magnet链接>
+#     python -m caoliu.search top -n 20
+#     python -m caoliu.search serve --port 8765
+
+import argparse
+import csv
+import json
+import os
+import re
+import sqlite3
+import unicodedata
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+# CJK 字符范围（中日韩统一表意文字、扩展A、兼容表意文字、假名、韩文）
+_CJK_RE = re.compile(
+    '[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+'
+)
+_WORD_RE = re.compile(r'[0-9a-z]+')
+_INFOHASH_RE = re.compile(r'([0-9a-fA-F]{40})')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id             INTEGER PRIMARY KEY,
+    video_id       TEXT NOT NULL UNIQUE,
+    title          TEXT,
+    url            TEXT,
+    download_link  TEXT,
+    infohash       TEXT,
+    download_count INTEGER,
+    crawled_ts     INTEGER,
+    images         TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_items_download_count ON items(download_count);
+CREATE INDEX IF NOT EXISTS idx_items_crawled_ts ON items(crawled_ts);
+CREATE INDEX IF NOT EXISTS idx_items_infohash ON items(infohash);
+CREATE TABLE IF NOT EXISTS postings (
+    token   TEXT NOT NULL,
+    item_id INTEGER NOT NULL,
+    PRIMARY KEY (token, item_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS token_stats (
+    token TEXT PRIMARY KEY,
+    df    INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+# 索引格式版本，低于此版本的数据库以可写方式打开时会重建倒排索引
+_SCHEMA_VERSION = 2
+
+# 单次查询最多返回的条目数
+MAX_QUERY_LIMIT = 1000
+
+
+def normalize(text):
+    """全角转半角并转小写"""
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def tokenize(text):
+    """
+    切分查询词
+    - CJK 连续片段按二元组切分（单字片段保留单字）
+    - 英文/数字按整词切分
+    """
+    text = normalize(text)
+    tokens = []
+    for run in _CJK_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(_WORD_RE.findall(_CJK_RE.sub(' ', text)))
+    return list(dict.fromkeys(tokens))
+
+
+def index_tokens(text):
+    """切分标题用于建索引：在查询词的基础上补充 CJK 单字，使单字查询也能命中"""
+    tokens = tokenize(text)
+    for run in _CJK_RE.findall(normalize(text)):
+        tokens.extend(run)
+    return list(dict.fromkeys(tokens))
+
+
+def extract_infohash(text):
+    """从 magnet 链接或裸 hash 中提取小写 infohash"""
+    if not text:
+        return None
+    match = _INFOHASH_RE.search(text)
+    return match.group(1).lower() if match else None
+
+
+def _to_timestamp(crawled_at, strict=False):
+    """ISO 时间字符串转 UTC 时间戳，strict 时无法解析则抛出 ValueError"""
+    if not crawled_at:
+        return None
+    try:
+        return int(datetime.fromisoformat(crawled_at).timestamp())
+    except ValueError:
+        if strict:
+            raise ValueError(f'无法解析的时间: {crawled_at}')
+        return None
+
+
+def item_to_entry(item):
+    """把 item 转换为索引条目（可安全地交给 I/O 线程）"""
+    return {
+        'video_id': item.get('video_id'),
+        'title': item.get('title', ''),
+        'url': item.get('url'),
+        'download_link': item.get('download_link'),
+        'download_count': item.get('download_count'),
+        'crawled_ts': _to_timestamp(item.get('crawled_at')),
+        'images': list(item.get('images') or []),
+    }
+
+
+class ArchiveIndex:
+    """
+    归档索引，所有写操作由调用方保证串行
+    readonly=True 时以只读方式打开已有的数据库，不建表、不升级格式，
+    供查询服务和命令行查询使用，不会与爬虫的写入争用
+    """
+
+    def __init__(self, db_path, download_dir='./downloads', readonly=False):
+        self.db_path = db_path
+        self.download_dir = download_dir
+        if readonly:
+            self.conn = sqlite3.connect(f'{Path(db_path).resolve().as_uri()}?mode=ro', uri=True)
+            self.conn.row_factory = sqlite3.Row
+            self.conn.create_function('caoliu_normalize', 1, normalize, deterministic=True)
+            if self.conn.execute('PRAGMA user_version').fetchone()[0] < _SCHEMA_VERSION:
+                self.conn.close()
+                raise sqlite3.OperationalError('索引格式过旧，请先运行 rebuild 或启动一次爬虫完成升级')
+            return
+
+        # Pipeline 在 I/O 线程池中使用，写入已由 DeferredLock 串行化
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.create_function('caoliu_normalize', 1, normalize, deterministic=True)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(_SCHEMA)
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] < _SCHEMA_VERSION:
+            self._reindex_postings()
+
+    def close(self):
+        self.conn.close()
+
+    def _reindex_postings(self):
+        """按当前切分规则重建倒排索引和词频"""
+        with self.conn:
+            self.conn.execute('DELETE FROM postings')
+            self.conn.execute('DELETE FROM token_stats')
+            for row in self.conn.execute('SELECT id, title FROM items').fetchall():
+                self._add_postings(row['id'], row['title'])
+            self.conn.execute(f'PRAGMA user_version = {_SCHEMA_VERSION}')
+
+    # ---------- 写入 ----------
+
+    def add_entries(self, entries):
+        """在一个事务中写入一批条目，已存在的 video_id 会被覆盖"""
+        with self.conn:
+            for entry in entries:
+                self._add_entry(entry)
+
+    def _add_entry(self, entry):
+        cur = self.conn.execute(
+            'SELECT id, title FROM items WHERE video_id = ?', (entry['video_id'],)
+        )
+        row = cur.fetchone()
+        if row is not None:
+            self.conn.executemany(
+                'UPDATE token_stats SET df = df - 1 WHERE token = ?',
+                [(token,) for token in index_tokens(row['title'])],
+            )
+            self.conn.execute('DELETE FROM postings WHERE item_id = ?', (row['id'],))
+            self.conn.execute('DELETE FROM items WHERE id = ?', (row['id'],))
+
+        cur = self.conn.execute(
+            'INSERT INTO items (video_id, title, url, download_link, infohash, '
+            'download_count, crawled_ts, images) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                entry['video_id'],
+                entry['title'],
+                entry['url'],
+                entry['download_link'],
+                extract_infohash(entry['download_link']),
+                entry['download_count'],
+                entry['crawled_ts'],
+                json.dumps(entry['images'], ensure_ascii=False),
+            ),
+        )
+        self._add_postings(cur.lastrowid, entry['title'])
+
+    def _add_postings(self, item_id, title):
+        tokens = index_tokens(title)
+        self.conn.executemany(
+            'INSERT INTO postings (token, item_id) VALUES (?, ?)',
+            [(token, item_id) for token in tokens],
+        )
+        self.conn.executemany(
+            'INSERT INTO token_stats (token, df) VALUES (?, 1) '
+            'ON CONFLICT(token) DO UPDATE SET df = df + 1',
+            [(token,) for token in tokens],
+        )
+
+    def rebuild_from_archive(self):
+        """从已有的 index.csv 和 video_* 文件夹重建索引，返回条目数"""
+        csv_path = os.path.join(self.download_dir, 'index.csv')
+        if not os.path.exists(csv_path):
+            return 0
+
+        entries = []
+        with open(csv_path, newline='', encoding='utf-8-sig') as f:
+            for row in csv.DictReader(f):
+                video_id = row.get('video_id')
+                if not video_id:
+                    continue
+                folder = os.path.join(self.download_dir, video_id)
+                if not os.path.isdir(folder):
+                    continue
+                count = row.get('download_count') or ''
+                entries.append({
+                    'video_id': video_id,
+                    'title': row.get('title', ''),
+                    'url': None,
+                    'download_link': row.get('download_link'),
+                    'download_count': int(count) if count.isdigit() else None,
+                    # 旧数据没有抓取时间，使用文件夹修改时间代替
+                    'crawled_ts': int(os.path.getmtime(folder)),
+                    'images': [f'{video_id}/{name}' for name in sorted(os.listdir(folder))],
+                })
+
+        with self.conn:
+            self.conn.execute('DELETE FROM postings')
+            self.conn.execute('DELETE FROM token_stats')
+            self.conn.execute('DELETE FROM items')
+        self.add_entries(entries)
+        return len(entries)
+
+    # ---------- 查询 ----------
+
+    def search_title(self, query, limit=20):
+        """
+        标题检索：所有词项都命中，按下载量降序
+        - 最稀有的词项命中条目较少时，从它的倒排列表出发，其余词项逐条校验
+        - 所有词项都很常见时，沿 download_count 索引降序扫描，凑满 limit 即停止
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        placeholders = ', '.join('?' * len(tokens))
+        df = dict(self.conn.execute(
+            f'SELECT token, df FROM token_stats WHERE token IN ({placeholders})', tokens
+        ).fetchall())
+        if any(df.get(token, 0) <= 0 for token in tokens):
+            return []
+        tokens.sort(key=lambda token: df[token])
+
+        # 二元组命中不代表相邻，再用原文做一次子串校验
+        terms = normalize(query).split()
+        conditions = ['EXISTS (SELECT 1 FROM postings WHERE token = ? AND item_id = i.id)'] * len(tokens)
+        conditions += ['instr(caoliu_normalize(i.title), ?) > 0'] * len(terms)
+
+        # 估算命中数：同一个词内的词项视为完全相关，不同词之间视为相互独立
+        # 倒排驱动约需读取最稀有词项的 df 行，索引扫描约需读取 limit * N / 命中数 行
+        total = self.conn.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+        estimated = float(total)
+        for term in terms:
+            term_tokens = tokenize(term)
+            if term_tokens:
+                estimated *= min(df[token] for token in term_tokens) / total
+        scan_cost = min(total, limit * total / max(estimated, 1))
+        if df[tokens[0]] <= scan_cost:
+            rows = self.conn.execute(
+                'SELECT i.* FROM postings p JOIN items i ON i.id = p.item_id '
+                f'WHERE p.token = ? AND {" AND ".join(conditions[1:])} '
+                'ORDER BY i.download_count DESC LIMIT ?',
+                [tokens[0]] + tokens[1:] + terms + [limit],
+            )
+        else:
+            rows = self.conn.execute(
+                'SELECT i.* FROM items i INDEXED BY idx_items_download_count '
+                f'WHERE {" AND ".join(conditions)} '
+                'ORDER BY i.download_count DESC LIMIT ?',
+                tokens + terms + [limit],
+            )
+        return [self._to_result(row) for row in rows]
+
+    def find_infohash(self, text):
+        """按 infohash（或 magnet 链接）精确查找"""
+        infohash = extract_infohash(text)
+        if infohash is None:
+            return []
+        rows = self.conn.execute('SELECT * FROM items WHERE infohash = ?', (infohash,))
+        return [self._to_result(row) for row in rows]
+
+    def top_downloads(self, limit=20, min_count=None):
+        """下载量最高的条目"""
+        rows = self.conn.execute(
+            'SELECT * FROM items WHERE download_count >= ? '
+            'ORDER BY download_count DESC LIMIT ?',
+            (min_count or 0, limit),
+        )
+        return [self._to_result(row) for row in rows]
+
+    def recent(self, limit=20, since=None):
+        """最近抓取的条目，since 为 ISO 时间字符串，无法解析时抛出 ValueError"""
+        since_ts = _to_timestamp(since, strict=True) if since else 0
+        rows = self.conn.execute(
+            'SELECT * FROM items WHERE crawled_ts >= ? '
+            'ORDER BY crawled_ts DESC LIMIT ?',
+            (since_ts, limit),
+        )
+        return [self._to_result(row) for row in rows]
+
+    def _to_result(self, row):
+        crawled_at = None
+        if row['crawled_ts'] is not None:
+            crawled_at = datetime.fromtimestamp(row['crawled_ts'], timezone.utc).astimezone().isoformat()
+        return {
+            'video_id': row['video_id'],
+            'title': row['title'],
+            'url': row['url'],
+            'download_link': row['download_link'],
+            'infohash': row['infohash'],
+            'download_count': row['download_count'],
+            'crawled_at': crawled_at,
+            'folder': os.path.join(self.download_dir, row['video_id']),
+            'images': [os.path.join(self.download_dir, p) for p in json.loads(row['images'] or '[]')],
+        }
+
+
+# ---------- 查询服务 ----------
+
+class _QueryHandler(BaseHTTPRequestHandler):
+    """
+    GET /search?q=关键词&limit=20
+    GET /infohash/<infohash>
+    GET /top?limit=20&min=1500
+    GET /recent?limit=20&since=2026-01-01T00:00:00+08:00
+    """
+
+    db_path = None
+    download_dir = None
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        try:
+            limit = int(params.get('limit', 20))
+            min_count = int(params['min']) if params.get('min') else None
+        except ValueError:
+            return self._send(400, {'error': 'limit / min 必须是整数'})
+        if not 1 <= limit <= MAX_QUERY_LIMIT:
+            return self._send(400, {'error': f'limit 必须在 1~{MAX_QUERY_LIMIT} 之间'})
+
+        # 每个请求独立的只读连接，WAL 模式下与爬虫写入互不阻塞
+        try:
+            index = ArchiveIndex(self.db_path, self.download_dir, readonly=True)
+        except sqlite3.Error as e:
+            return self._send(503, {'error': f'索引不可用: {e}'})
+        try:
+            if parsed.path == '/search':
+                results = index.search_title(params.get('q', ''), limit)
+            elif parsed.path.startswith('/infohash/'):
+                results = index.find_infohash(parsed.path[len('/infohash/'):])
+            elif parsed.path == '/top':
+                results = index.top_downloads(limit, min_count)
+            elif parsed.path == '/recent':
+                try:
+                    results = index.recent(limit, params.get('since'))
+                except ValueError as e:
+                    return self._send(400, {'error': str(e)})
+            else:
+                return self._send(404, {'error': '未知路径'})
+        finally:
+            index.close()
+        self._send(200, {'count': len(results), 'results': results})
+
+    def _send(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(db_path, download_dir, host='127.0.0.1', port=8765):
+    """启动本地查询服务"""
+    handler = type('QueryHandler', (_QueryHandler,), {
+        'db_path': db_path,
+        'download_dir': download_dir,
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f'查询服务已启动: http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# ---------- 命令行 ----------
+
+def _default_paths():
+    """从项目 settings 读取默认路径"""
+    from scrapy.utils.project import get_project_settings
+    settings = get_project_settings()
+    download_dir = settings.get('CAOLIU_DOWNLOAD_DIR', './downloads')
+    db_path = settings.get('CAOLIU_SEARCH_DB') or os.path.join(download_dir, 'search.db')
+    return db_path, download_dir
+
+
+def _limit_arg(value):
+    limit = int(value)
+    if not 1 <= limit <= MAX_QUERY_LIMIT:
+        raise argparse.ArgumentTypeError(f'必须在 1~{MAX_QUERY_LIMIT} 之间')
+    return limit
+
+
+def main(argv=None):
+    db_path, download_dir = _default_paths()
+
+    parser = argparse.ArgumentParser(prog='python -m caoliu.search', description='检索本地归档')
+    parser.add_argument('--db', default=db_path, help='索引数据库路径')
+    parser.add_argument('--download-dir', default=download_dir, help='下载根目录')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('title', help='按标题检索')
+    p.add_argument('query')
+    p.add_argument('-n', '--limit', type=_limit_arg, default=20)
+
+    p = sub.add_parser('infohash', help='按 infohash 或 magnet 链接查找')
+    p.add_argument('infohash')
+
+    p = sub.add_parser('top', help='下载量最高')
+    p.add_argument('-n', '--limit', type=_limit_arg, default=20)
+    p.add_argument('--min', type=int, default=None, help='最低下载量')
+
+    p = sub.add_parser('recent', help='最近抓取')
+    p.add_argument('-n', '--limit', type=_limit_arg, default=20)
+    p.add_argument('--since', default=None, help='起始时间（ISO 8601）')
+
+    sub.add_parser('rebuild', help='从 index.csv 和 video_* 文件夹重建索引')
+
+    p = sub.add_parser('serve', help='启动本地 HTTP 查询服务')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8765)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        # 启动时以可写方式打开一次，完成建表和格式升级，之后的查询都是只读的
+        ArchiveIndex(args.db, args.download_dir).close()
+        serve(args.db, args.download_dir, args.host, args.port)
+        return
+
+    if args.command == 'rebuild':
+        index = ArchiveIndex(args.db, args.download_dir)
+        try:
+            print(f'已重建索引: {index.rebuild_from_archive()} 条')
+        finally:
+            index.close()
+        return
+
+    try:
+        index = ArchiveIndex(args.db, args.download_dir, readonly=True)
+    except sqlite3.Error as e:
+        parser.error(f'无法打开索引 {args.db}: {e}')
+    try:
+        if args.command == 'title':
+            results = index.search_title(args.query, args.limit)
+        elif args.command == 'infohash':
+            results = index.find_infohash(args.infohash)
+        elif args.command == 'top':
+            results = index.top_downloads(args.limit, args.min)
+        else:
+            try:
+                results = index.recent(args.limit, args.since)
+            except ValueError as e:
+                parser.error(str(e))
+    finally:
+        index.close()
+
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
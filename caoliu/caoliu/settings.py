@@ -50,8 +50,16 @@ DOWNLOAD_DELAY = 1
 DOWNLOADER_MIDDLEWARES = {
     # 禁用OffsiteMiddleware，允许下载外部图片（如qpic.ws）
     "scrapy.downloadermiddlewares.offsite.OffsiteMiddleware": None,
+    # 图床熔断（需排在 RetryMiddleware(550) 之后、Cloudflare 绕过中间件之前）
+    "caoliu.middlewares.ImageHostCircuitBreakerMiddleware": 560,
     # 启用 Cloudflare 绕过中间件（用于处理 tu.ymawv.la 等受保护图床）
-    "caoliu.middlewares.CloudflareBypassMiddleware": 543,
+    "caoliu.middlewares.CloudflareBypassMiddleware": 570,
+}
+
+# 图床熔断：请求出队、真正发出前再检查一次熔断（需要 Scrapy >= 2.14）
+DOWNLOAD_HANDLERS = {
+    "http": "caoliu.middlewares.CircuitBreakerDownloadHandler",
+    "https": "caoliu.middlewares.CircuitBreakerDownloadHandler",
 }
 
 # Enable or disable extensions
@@ -66,6 +74,7 @@ ITEM_PIPELINES = {
     "caoliu.pipelines.CaoliuIndexPipeline": 1,      # 首先分配video_id（不写入CSV）
     "caoliu.pipelines.CaoliuImagesPipeline": 100,   # 下载图片并标记成功/失败
     "caoliu.pipelines.CaoliuFinalPipeline": 300,    # 成功则写入CSV，失败则删除文件夹
+    "caoliu.pipelines.CaoliuExportPipeline": 400,   # 导出已保存的item（Parquet / JSONL）
 }
 
 # ============ 草榴爬虫配置 ============
@@ -75,6 +84,26 @@ CAOLIU_DOWNLOAD_DIR = "./downloads"
 # 最低下载量阈值（只抓取下载量 >= 此值的帖子，设为 0 表示不过滤）
 CAOLIU_MIN_DOWNLOAD_COUNT = 1500
 
+# 磁盘I/O线程池（Pipeline的文件操作在此执行，不阻塞网络下载）
+CAOLIU_IO_THREADS = 2
+# index.csv 批量写入：攒够多少条写一次
+CAOLIU_CSV_BATCH_SIZE = 20
+# index.csv 批量写入：最长等待多少秒写一次
+CAOLIU_CSV_FLUSH_INTERVAL = 1.0
+
+# 检索索引数据库（随 index.csv 增量更新，设为 None 表示不建立索引）
+# 查询: python -m caoliu.search title 关键词 / python -m caoliu.search serve
+CAOLIU_SEARCH_DB = "./downloads/search.db"
+
+# Parquet 导出目录（按抓取日期分区，需要额外安装 pyarrow，如 "./downloads/parquet"；None 表示不导出）
+CAOLIU_EXPORT_PARQUET_DIR = None
+# Parquet 每攒够多少条写一个 part 文件
+CAOLIU_EXPORT_BATCH_SIZE = 500
+# Parquet 最长等待多少秒写一个 part 文件（爬虫结束时写出剩余部分）
+CAOLIU_EXPORT_FLUSH_INTERVAL = 60.0
+# JSONL 流式输出："-" 表示 stdout，也可以是文件或命名管道路径，None 表示不输出
+CAOLIU_EXPORT_JSONL = None
+
 # 图片保存路径 (相对于项目根目录)
 IMAGES_STORE = "./downloads"
 
@@ -84,6 +113,21 @@ IMAGES_DOWNLOAD_TIMEOUT = 30
 # 允许重定向
 MEDIA_ALLOW_REDIRECTS = True
 
+# ============ 图床熔断配置 ============
+# 每个图床统计最近多少次请求
+CAOLIU_CIRCUIT_WINDOW = 20
+# 至少多少次请求后才判断是否熔断
+CAOLIU_CIRCUIT_MIN_CALLS = 5
+# 失败率达到多少时熔断
+CAOLIU_CIRCUIT_FAILURE_RATE = 0.5
+# 下载耗时（不含排队等待）超过多少秒的请求也算失败
+CAOLIU_CIRCUIT_SLOW_SECONDS = 15
+# 熔断多少秒后探测，探测失败则翻倍，最长不超过 MAX
+CAOLIU_CIRCUIT_OPEN_SECONDS = 60
+CAOLIU_CIRCUIT_MAX_OPEN_SECONDS = 1800
+# 熔断状态保存文件（跨运行保留，设为 None 表示不保存）
+CAOLIU_CIRCUIT_STATE_FILE = "./downloads/circuit_state.json"
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 # AUTOTHROTTLE_ENABLED = True
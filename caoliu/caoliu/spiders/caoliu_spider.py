@@ -1,5 +1,6 @@
 import scrapy
 import re
+from datetime import datetime
 from urllib.parse import urlparse, parse_qs
 from caoliu.items import CaoliuItem
 
@@ -126,6 +127,8 @@ class CaoliuSpider(scrapy.Spider):
 
         # 最多取前5张
         item["image_urls"] = valid_images[:5]
+        # 其余图片作为候选，图床熔断时替换使用
+        item["alternate_image_urls"] = valid_images[5:]
 
         # 3. 下载链接 - 从rmdown URL提取hash并构造magnet链接
         # XPath: //*[@id="rmlink"]
@@ -136,6 +139,9 @@ class CaoliuSpider(scrapy.Spider):
         # 4. 下载量 - 从列表页传递过来
         item["download_count"] = response.meta.get("download_count")
 
+        # 5. 抓取时间
+        item["crawled_at"] = datetime.now().astimezone().isoformat(timespec="seconds")
+
         self.logger.info(
             f"解析完成: {item['title']}, 图片数: {len(item['image_urls'])}, "
             f"下载量: {item['download_count']}, magnet: {magnet_link is not None}"